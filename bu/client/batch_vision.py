@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 import os
 import sys
-import time
 import json
 import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ===== 設定 =====
 API_BASE = os.environ.get("VLLM_BASE", "http://127.0.0.1:9000")
@@ -25,9 +27,27 @@ DEFAULT_PROMPT = "この画像の要点を日本語で簡潔に説明してく
 
 # タイムアウト/リトライ
 HTTP_TIMEOUT = 120
-RETRY = 3
+RETRY = 3  # 試行回数（初回を含む）。urllib3 の Retry には再試行回数として RETRY - 1 を渡す
 BACKOFF = 2.0
 
+# 出力 JSON をインデント付きにする（デバッグ用。既定はコンパクト）
+PRETTY_JSON = os.environ.get("VLLM_PRETTY_JSON", "") == "1"
+
+# 同時リクエスト数
+CONCURRENCY = int(os.environ.get("VLLM_CONCURRENCY", "1"))
+
+# 接続プール（Keep-Alive で毎回のハンドシェイクを省く）。5xx/429 の再試行は urllib3 側で行う
+HTTP_POOL_SIZE = max(32, CONCURRENCY)
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=HTTP_POOL_SIZE,
+    pool_maxsize=HTTP_POOL_SIZE,
+    max_retries=Retry(total=RETRY - 1, backoff_factor=BACKOFF, status_forcelist=(429, 502, 503, 504),
+                      allowed_methods=frozenset({"POST"}), respect_retry_after_header=True),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
 
 def to_container_file_url(host_path: Path) -> str:
     """
@@ -65,20 +85,21 @@ def request_one(image_path: Path) -> dict:
         "max_tokens": 256
     }
 
-    last_err = None
-    for i in range(1, RETRY + 1):
-        try:
-            r = requests.post(url, headers=headers, data=json.dumps(payload), timeout=HTTP_TIMEOUT)
-            if r.status_code == 200:
-                return r.json()
-            else:
-                last_err = RuntimeError(f"HTTP {r.status_code}: {r.text[:200]}")
-        except Exception as e:
-            last_err = e
-        # backoff
-        time.sleep(BACKOFF * i)
+    r = SESSION.post(url, json=payload, headers=headers, timeout=HTTP_TIMEOUT)
+    if r.status_code != 200:
+        raise RuntimeError(f"HTTP {r.status_code}: {r.text[:200]}")
+    return r.json()
+
 
-    raise last_err
+def process_one(p: Path):
+    out_path = OUT_DIR / (p.stem + ".json")
+    res = request_one(p)
+    with open(out_path, "w", encoding="utf-8") as f:
+        if PRETTY_JSON:
+            json.dump(res, f, ensure_ascii=False, indent=2)
+        else:
+            json.dump(res, f, ensure_ascii=False, separators=(",", ":"))
+    return p, out_path
 
 
 def main():
@@ -87,21 +108,29 @@ def main():
         print(f"No images found in: {IN_DIR}")
         return
 
+    # 既存の出力は画像ごとに exists() せず、OUT_DIR を1回だけ読んで除外する
+    with os.scandir(OUT_DIR) as it:
+        done = {e.name[:-5] for e in it if e.name.endswith(".json")}
+    total = len(imgs)
+    imgs = [p for p in imgs if p.stem not in done]
+    if total > len(imgs):
+        print(f"Skipped {total - len(imgs)} images (JSON already exists in {OUT_DIR})")
+    if not imgs:
+        return
+
     print(f"Found {len(imgs)} images. Start processing...")
 
-    for idx, p in enumerate(imgs, 1):
-        out_path = OUT_DIR / (p.stem + ".json")
-        if out_path.exists():
-            print(f"[{idx}/{len(imgs)}] skip (exists): {p}")
-            continue
-
-        try:
-            res = request_one(p)
-            with open(out_path, "w", encoding="utf-8") as f:
-                json.dump(res, f, ensure_ascii=False, indent=2)
-            print(f"[{idx}/{len(imgs)}] OK: {p} -> {out_path}")
-        except Exception as e:
-            print(f"[{idx}/{len(imgs)}] ERROR request failed: {p} -> {e}", file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as ex:
+        futures = {ex.submit(process_one, p): p for p in imgs}
+        for idx, fut in enumerate(as_completed(futures), 1):
+            p = futures[fut]
+            try:
+                _, out_path = fut.result()
+                print(f"[{idx}/{len(imgs)}] OK: {p} -> {out_path}")
+            except Exception as e:
+                print(f"[{idx}/{len(imgs)}] ERROR request failed: {p} -> {e}", file=sys.stderr)
+
+    SESSION.close()
 
 
 if __name__ == "__main__":
@@ -1,8 +1,36 @@
 #!/usr/bin/env python3
-import os, sys, json, time, shutil, glob, re, argparse, base64, mimetypes
+import os, json, shutil, re, argparse, base64, mimetypes, struct, functools
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 from io import BytesIO
-from typing import Any, Dict, Optional, Tuple, List
+import threading
+from typing import Any, BinaryIO, Dict, Iterator, Optional, Tuple, List
+import urllib.parse
 import yaml, requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+try:
+    import pybase64  # type: ignore
+except ImportError:
+    pybase64 = None
+
+def json_dumps(obj: Any, indent: bool = False) -> bytes:
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option)
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def json_loads(data: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
 def load_config(path: str) -> Dict[str, Any]:
     with open(path, "r", encoding="utf-8") as f:
@@ -12,10 +40,61 @@ def ensure_dirs(*dirs: str):
     for d in dirs:
         os.makedirs(d, exist_ok=True)
 
+def iter_jpgs(root: str) -> Iterator[str]:
+    # scandir は getdents の d_type を使うので、ファイルごとの stat が要らない。
+    # glob と同様に隠しエントリ（macOS の ._*.jpg 等）は除外し、読めないディレクトリは飛ばし、
+    # ディレクトリへのシンボリックリンクは辿る（循環防止に (st_dev, st_ino) を記録）
+    stack = [root]
+    visited = set()
+    while stack:
+        d = stack.pop()
+        try:
+            st = os.stat(d)
+            key = (st.st_dev, st.st_ino)
+            if key in visited:
+                continue
+            visited.add(key)
+            it = os.scandir(d)
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                if e.name.startswith("."):
+                    continue
+                if e.is_dir():
+                    stack.append(e.path)
+                elif e.name.lower().endswith(".jpg"):
+                    yield e.path
+
 THUMB_MAX_DIM = 512
 
+# 同一の vLLM エンドポイントへ大量に投げるため、Keep-Alive で接続を使い回す
+HTTP_POOL_SIZE = 32
+SESSION = requests.Session()
+
+
+RETRY_STATUS = (429, 502, 503, 504)
+
 
-def encode_image_as_data_url(path: str) -> Tuple[str, Optional[Tuple[int, int]]]:
+def mount_http_adapter(session: requests.Session, pool_size: int, retry: int = 0, backoff: float = 0.0):
+    # 同時実行数よりプールが小さいと、溢れた分の接続が毎回張り直し・破棄される
+    # リトライは urllib3 に任せ、同じ Keep-Alive 接続上でやり直す（Retry-After も尊重）
+    retries = Retry(
+        total=retry,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUS,
+        allowed_methods=frozenset({"POST"}),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+
+mount_http_adapter(SESSION, HTTP_POOL_SIZE)
+
+
+def encode_image_as_data_url(path: str, optimize_jpeg: bool = False) -> Tuple[str, Optional[Tuple[int, int]]]:
     mime, _ = mimetypes.guess_type(path)
     size: Optional[Tuple[int, int]] = None
     image_bytes: Optional[bytes] = None
@@ -23,14 +102,18 @@ def encode_image_as_data_url(path: str) -> Tuple[str, Optional[Tuple[int, int]]]
         from PIL import Image  # type: ignore
         with Image.open(path) as img:  # type: ignore
             size = img.size
+            if img.format == "JPEG" and max(size) > THUMB_MAX_DIM * 2:
+                # libjpeg の縮小 IDCT (1/2, 1/4, 1/8) でデコード時点で縮めておく
+                img.draft("RGB", (THUMB_MAX_DIM * 2, THUMB_MAX_DIM * 2))
             working = img
             if max(img.size) > THUMB_MAX_DIM:
                 working = img.copy()
-                working.thumbnail((THUMB_MAX_DIM, THUMB_MAX_DIM), Image.LANCZOS)
+                working.thumbnail((THUMB_MAX_DIM, THUMB_MAX_DIM), Image.BICUBIC)
             if working.mode not in ("RGB", "L"):
                 working = working.convert("RGB")
             buffer = BytesIO()
-            working.save(buffer, format="JPEG", quality=85)
+            # optimize=True は Huffman テーブルを最適化するだけで画素は変わらない
+            working.save(buffer, format="JPEG", quality=85, optimize=optimize_jpeg)
             image_bytes = buffer.getvalue()
             mime = "image/jpeg"
     except Exception:
@@ -42,17 +125,93 @@ def encode_image_as_data_url(path: str) -> Tuple[str, Optional[Tuple[int, int]]]
         if not mime:
             mime = "image/jpeg"
         if size is None:
-            try:
-                from PIL import Image  # type: ignore
-                with Image.open(path) as img:  # type: ignore
-                    size = img.size
-            except Exception:
-                size = None
+            # PIL で開けなかったファイルを再度 PIL で開いても無駄なので、読んだバイト列のヘッダから取る
+            size = _header_image_size(BytesIO(image_bytes))
 
-    encoded = base64.b64encode(image_bytes).decode("ascii")
+    if pybase64 is not None:
+        encoded = pybase64.b64encode_as_string(image_bytes)
+    else:
+        encoded = base64.b64encode(image_bytes).decode("ascii")
     return f"data:{mime};base64,{encoded}", size
 
 
+def read_image_size(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        from PIL import Image  # type: ignore
+        with Image.open(path) as img:  # type: ignore
+            return img.size
+    except Exception:
+        return None
+
+
+# SOF マーカー（DHT=C4, JPG=C8, DAC=CC は除く）
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _header_image_size(f: BinaryIO) -> Optional[Tuple[int, int]]:
+    """PNG の IHDR / JPEG の SOFn ヘッダだけを読んで (w, h) を返す。画素はデコードしない。"""
+    try:
+        head = f.read(24)
+        if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+            w, h = struct.unpack(">II", head[16:24])
+            return w, h
+        if head[:2] == b"\xff\xd8":
+            # EXIF サムネイル内の SOF を拾わないよう、セグメント長に従って辿る
+            f.seek(2)
+            while True:
+                b = f.read(1)
+                while b and b != b"\xff":
+                    b = f.read(1)
+                while b == b"\xff":
+                    b = f.read(1)
+                if not b:
+                    break
+                marker = b[0]
+                if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                    continue
+                if marker in (0xD9, 0xDA):
+                    break
+                seg = f.read(2)
+                if len(seg) < 2:
+                    break
+                (length,) = struct.unpack(">H", seg)
+                if marker in _JPEG_SOF_MARKERS:
+                    sof = f.read(5)
+                    if len(sof) < 5:
+                        break
+                    h, w = struct.unpack(">xHH", sof)
+                    if w and h:
+                        return w, h
+                    break
+                f.seek(length - 2, os.SEEK_CUR)
+    except struct.error:
+        pass
+    return None
+
+
+def fast_image_size(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        with open(path, "rb") as f:
+            size = _header_image_size(f)
+        if size:
+            return size
+    except OSError:
+        pass
+    return read_image_size(path)
+
+
+def to_container_file_url(host_path: str, host_data_dir: str, container_data_dir: str) -> str:
+    """
+    ホストの data/in/xxx.jpg -> コンテナでは /data/in/xxx.jpg
+    -> image_url として 'file:///data/in/xxx.jpg'
+    """
+    rel = os.path.relpath(os.path.abspath(host_path), host_data_dir)
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        raise ValueError(f"{host_path} is not under {host_data_dir}")
+    container_path = container_data_dir.rstrip("/") + "/" + rel.replace(os.sep, "/")
+    return f"file://{urllib.parse.quote(container_path)}"
+
+
 def _to_float(value: Any) -> Optional[float]:
     if isinstance(value, (int, float)):
         return float(value)
@@ -136,14 +295,33 @@ def ensure_bbox(bbox: List[int], point: List[int], image_size: Optional[Tuple[in
     return [0, 0, 0, 0]
 
 
+def fast_materialize(src: str, dst: str):
+    # 同一ファイルシステムならハードリンク（データ I/O なし）、別デバイス等ではコピー
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+@functools.lru_cache(maxsize=64)
+def _get_font(size: int):
+    from PIL import ImageFont  # type: ignore
+    try:
+        return ImageFont.truetype("DejaVuSans.ttf", size)
+    except Exception:
+        return ImageFont.load_default()
+
+
 def annotate_detection(src_path: str, dst_path: str, bbox: List[int], label: str):
     if not bbox or len(bbox) < 4 or bbox[0] == bbox[2] or bbox[1] == bbox[3]:
-        shutil.copy2(src_path, dst_path)
+        fast_materialize(src_path, dst_path)
         return
     try:
-        from PIL import Image, ImageDraw, ImageFont  # type: ignore
+        from PIL import Image, ImageDraw  # type: ignore
     except Exception:
-        shutil.copy2(src_path, dst_path)
+        fast_materialize(src_path, dst_path)
         return
 
     with Image.open(src_path) as img:  # type: ignore
@@ -151,10 +329,9 @@ def annotate_detection(src_path: str, dst_path: str, bbox: List[int], label: str
         x1, y1, x2, y2 = bbox
         draw.rectangle([x1, y1, x2, y2], outline="red", width=max(2, int(round(min(img.size) * 0.004))))
         text = label.strip() if label else "target"
-        try:
-            font = ImageFont.truetype("DejaVuSans.ttf", max(12, int(round(min(img.size) * 0.03))))
-        except Exception:
-            font = ImageFont.load_default()
+        # キャッシュが効くようフォントサイズは 4px 単位に丸める
+        font_size = max(12, int(round(min(img.size) * 0.03 / 4)) * 4)
+        font = _get_font(font_size)
         text_bbox = draw.textbbox((0, 0), text, font=font)
         text_w = text_bbox[2] - text_bbox[0]
         text_h = text_bbox[3] - text_bbox[1]
@@ -165,26 +342,33 @@ def annotate_detection(src_path: str, dst_path: str, bbox: List[int], label: str
         box_y2 = box_y1 + text_h + padding * 2
         draw.rectangle([box_x1, box_y1, box_x2, box_y2], fill="red")
         draw.text((box_x1 + padding, box_y1 + padding), text, fill="white", font=font)
+        # dst が入力へのハードリンクのまま上書きすると元画像を壊すので先に外す
+        if os.path.lexists(dst_path):
+            os.unlink(dst_path)
         img.save(dst_path)
 
 
+_RE_FENCE_OPEN = re.compile(r"^```(?:json)?", re.IGNORECASE)
+_RE_FENCE_CLOSE = re.compile(r"```$")
+_RE_JSON_BLOB = re.compile(r"\{.*\}", re.DOTALL)
+
+
 def clean_response_text(text: str) -> str:
     cleaned = text.strip()
     if cleaned.startswith("```"):
-        cleaned = re.sub(r"^```(?:json)?", "", cleaned, flags=re.IGNORECASE).strip()
-        cleaned = re.sub(r"```$", "", cleaned).strip()
+        cleaned = _RE_FENCE_OPEN.sub("", cleaned).strip()
+        cleaned = _RE_FENCE_CLOSE.sub("", cleaned).strip()
     cleaned = cleaned.replace("\\_", "_")
     return cleaned
 
 
 def extract_json(text: str) -> Optional[Dict[str, Any]]:
-    import re, json
     cleaned = clean_response_text(text)
-    m = re.search(r"\{.*\}", cleaned, re.DOTALL)
+    m = _RE_JSON_BLOB.search(cleaned)
     if not m:
         return None
     try:
-        return json.loads(m.group(0))
+        return json_loads(m.group(0))
     except Exception:
         return None
 
@@ -192,6 +376,7 @@ def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument("--input-dir", default=None, help="画像のルート（デフォルトは config.yaml の input_dir）")
     ap.add_argument("--output", default=None, help="JSONL の出力パス（指定時は1行/画像で追記）")
+    ap.add_argument("--pretty", action="store_true", help="画像ごとの JSON をインデント付きで書き出す（デバッグ用）")
     return ap.parse_args()
 
 def main():
@@ -209,18 +394,37 @@ def main():
     out_false  = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", cfg["image_out_false_dir"]))
     ensure_dirs(json_dir, out_true, out_false)
 
+    # サーバーが同じ data/ をマウントしている場合は画像を送らず file:// で参照させる
+    use_file_url = bool(cfg.get("use_file_url", False))
+    host_data_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", cfg.get("host_data_dir", "./data")))
+    container_data_dir = cfg.get("container_data_dir", "/data")
+    optimize_jpeg = bool(cfg.get("optimize_jpeg", False))
+
     system_prompt = cfg.get("system_prompt")
     instruction = cfg["instruction"]
     temperature = float(cfg.get("temperature", 0))
     max_tokens  = int(cfg.get("max_tokens", 256))
     retry       = int(cfg.get("retry", 2))
-
-    images = sorted(glob.glob(os.path.join(input_dir, "**", "*.jpg"), recursive=True))
-    if not images:
-        print(f"No .jpg found in: {input_dir}")
-        sys.exit(0)
-
-    print(f"Found {len(images)} images. Start processing...")
+    retry_backoff = float(cfg.get("retry_backoff", 1.5))
+
+    # 既に JSON がある画像は飛ばす（画像ごとに stat せず、json_dir を1回だけ読む）
+    done = set()
+    if cfg.get("skip_existing", True):
+        with os.scandir(json_dir) as it:
+            done = {e.name[:-5] for e in it if e.name.endswith(".json")}
+    skipped = 0
+
+    def pending(paths: Iterator[str]) -> Iterator[str]:
+        nonlocal skipped
+        for p in paths:
+            if os.path.splitext(os.path.basename(p))[0] in done:
+                skipped += 1
+                continue
+            yield p
+
+    # 一覧を作ってからソートせず、走査しながら順次パイプラインへ流す
+    images = pending(iter_jpgs(input_dir))
+    print(f"Scanning {input_dir}. Start processing...")
 
     headers = {
         "Content-Type": "application/json",
@@ -228,10 +432,39 @@ def main():
     }
     url = f"{base_url}/chat/completions"
 
-    out_jsonl = open(args.output, "a", encoding="utf-8") if args.output else None
+    out_jsonl = open(args.output, "ab") if args.output else None
+    jsonl_lock = threading.Lock()
+    concurrency = max(1, int(cfg.get("concurrency", 1)))
+    mount_http_adapter(SESSION, max(HTTP_POOL_SIZE, concurrency), retry, retry_backoff)
+
+    # 画像のエンコード（CPU）を先行させ、送信中（I/O）の待ち時間に重ねる。
+    # prefetch でエンコード済み・未送信の画像数を抑えメモリを制限する
+    prefetch = max(concurrency, int(cfg.get("prefetch", 8)))
+    # 同時に走るエンコードは prefetch 件までなので、それ以上ワーカーを立てても遊ぶだけ
+    encode_workers = int(cfg.get("encode_workers", 0)) or min(prefetch, os.cpu_count() or 1)
+    prefetch_slots = threading.Semaphore(prefetch)
+
+    def prepare_file_url(host_img: str) -> Tuple[str, Optional[Tuple[int, int]]]:
+        return to_container_file_url(host_img, host_data_dir, container_data_dir), fast_image_size(host_img)
+
+    if use_file_url:
+        # ヘッダを読むだけなのでスレッドで十分
+        encode_pool: Executor = ThreadPoolExecutor(max_workers=encode_workers)
+        prepare = prepare_file_url
+    elif cfg.get("encode_executor", "process") == "process":
+        # PIL のデコード・縮小は GIL を握る部分が残るため、プロセスで並列化する。
+        # 返り値は str と tuple だけなので pickle のコストは小さい
+        encode_pool = ProcessPoolExecutor(max_workers=encode_workers)
+        prepare = functools.partial(encode_image_as_data_url, optimize_jpeg=optimize_jpeg)
+    else:
+        encode_pool = ThreadPoolExecutor(max_workers=encode_workers)
+        prepare = functools.partial(encode_image_as_data_url, optimize_jpeg=optimize_jpeg)
 
-    for idx, host_img in enumerate(images, 1):
-        data_url, image_size = encode_image_as_data_url(host_img)
+    def process(host_img: str, prepared: Future) -> Tuple[str, Dict[str, Any]]:
+        try:
+            image_url, image_size = prepared.result()
+        finally:
+            prefetch_slots.release()
         messages = []
         if system_prompt:
             messages.append({"role": "system", "content": system_prompt})
@@ -246,7 +479,7 @@ def main():
                 messages.append({"role": "assistant", "content": assistant_text})
 
         user_content = [
-            {"type": "image_url", "image_url": {"url": data_url}},
+            {"type": "image_url", "image_url": {"url": image_url}},
             {"type": "text", "text": instruction},
         ]
         messages.append({"role": "user", "content": user_content})
@@ -258,21 +491,17 @@ def main():
             "messages": messages
         }
 
-        data = None
-        for attempt in range(retry + 1):
-            try:
-                r = requests.post(url, headers=headers, data=json.dumps(payload), timeout=180)
-                r.raise_for_status()
-                data = r.json()
-                break
-            except Exception as e:
-                if attempt >= retry:
-                    print(f"[{idx}/{len(images)}] ERROR request failed: {host_img} -> {e}")
-                time.sleep(1.5 * (attempt + 1))
-
-        if not data:
-            shutil.copy2(host_img, os.path.join(out_false, os.path.basename(host_img)))
-            continue
+        body = json_dumps(payload)
+        # 失敗時は画像を out_false に置いてから例外を上げ、report 側で1行だけ出力する
+        try:
+            r = SESSION.post(url, data=body, headers=headers, timeout=180)
+            r.raise_for_status()
+            data = json_loads(r.content)
+            if not data:
+                raise RuntimeError("empty response")
+        except Exception:
+            fast_materialize(host_img, os.path.join(out_false, os.path.basename(host_img)))
+            raise
 
         try:
             content = data["choices"][0]["message"]["content"]
@@ -283,7 +512,7 @@ def main():
         if content:
             cleaned = clean_response_text(content)
             try:
-                parsed = json.loads(cleaned)
+                parsed = json_loads(cleaned)
             except Exception:
                 parsed = extract_json(cleaned)
         if not parsed or not isinstance(parsed, dict):
@@ -307,8 +536,8 @@ def main():
 
         stem = os.path.splitext(os.path.basename(host_img))[0]
         json_path = os.path.join(json_dir, stem + ".json")
-        with open(json_path, "w", encoding="utf-8") as f:
-            json.dump(parsed, f, ensure_ascii=False, indent=2)
+        with open(json_path, "wb") as f:
+            f.write(json_dumps(parsed, indent=args.pretty))
 
         dst_dir = out_true if is_forbidden else out_false
         dst_path = os.path.join(dst_dir, os.path.basename(host_img))
@@ -316,20 +545,48 @@ def main():
             try:
                 annotate_detection(host_img, dst_path, parsed_bbox, parsed.get("reason", "target"))
             except Exception:
-                shutil.copy2(host_img, dst_path)
+                fast_materialize(host_img, dst_path)
         else:
-            shutil.copy2(host_img, dst_path)
+            fast_materialize(host_img, dst_path)
 
         if out_jsonl:
-            out_jsonl.write(json.dumps({
+            line = json_dumps({
                 "image": os.path.relpath(host_img, input_dir),
                 "result": parsed
-            }, ensure_ascii=False) + "\n")
+            }) + b"\n"
+            with jsonl_lock:
+                out_jsonl.write(line)
+
+        return host_img, parsed
 
-        print(f"[{idx}/{len(images)}] {os.path.basename(host_img)} -> {parsed}")
+    progress_lock = threading.Lock()
+    completed = 0
+
+    def report(host_img: str, fut: Future):
+        nonlocal completed
+        try:
+            _, parsed = fut.result()
+            msg = f"{os.path.basename(host_img)} -> {parsed}"
+        except Exception as e:
+            msg = f"ERROR: {host_img} -> {e}"
+        with progress_lock:
+            completed += 1
+            print(f"[{completed}] {msg}")
+
+    with encode_pool, ThreadPoolExecutor(max_workers=concurrency) as ex:
+        for p in images:
+            prefetch_slots.acquire()
+            prepared = encode_pool.submit(prepare, p)
+            ex.submit(process, p, prepared).add_done_callback(functools.partial(report, p))
+
+    if skipped:
+        print(f"Skipped {skipped} images (JSON already exists in {json_dir})")
+    if completed == 0 and skipped == 0:
+        print(f"No .jpg found in: {input_dir}")
 
     if out_jsonl:
         out_jsonl.close()
+    SESSION.close()
     print("Done.")
 
 if __name__ == "__main__":